@@ -7,23 +7,43 @@ MetaTrader 5 → AItuber Kit 統合システム (改善版)
 """
 
 import asyncio
+import gzip
+import hashlib
+import hmac
 import json
 import logging
+import os
+import sys
+import time
 import websockets
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Dict, Set, Optional
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
 import MetaTrader5 as mt5
 from datetime import datetime
 from aiohttp import web
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+def dumps_json(data) -> str:
+    """送信用JSON文字列を生成（orjsonがあれば高速パスを使用）"""
+    if orjson is not None:
+        # orjsonはUTF-8のbytesを返すので、テキストフレームで送るためにstrへ戻す
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False)
+
 # ==================== 設定 (Config) ====================
-@dataclass
+@dataclass(slots=True)
 class Config:
     """アプリケーションの設定を管理するクラス"""
     # 監視する通貨ペア（MT5のシンボル名）、小数点以下の桁数、日本語読み
@@ -49,179 +69,347 @@ class Config:
     ws_port: int = 8000
     # HTTPサーバー設定
     http_port: int = 8080
+    # ダッシュボード接続用トークン（環境変数 DASHBOARD_TOKEN、未設定なら認証なし）
+    dashboard_token: Optional[str] = field(default_factory=lambda: os.environ.get("DASHBOARD_TOKEN"))
+    # ネットワーク用に表示するIPアドレス（未設定なら起動時に自動検出）
+    external_ip: Optional[str] = None
 
 config = Config()
+CONFIG_FILE = "mt5_config.json"
 
 # ==================== メッセージブローカー ====================
+# クライアント種別
+AITUBER = 0
+DASHBOARD = 1
+
 class MessageBroker:
     def __init__(self):
-        self.clients: Set[websockets.WebSocketServerProtocol] = set()
-        self.dashboard_clients: Set[websockets.WebSocketServerProtocol] = set()
+        # 接続 → クライアント種別（AITUBER / DASHBOARD）
+        self.clients: Dict[websockets.WebSocketServerProtocol, int] = {}
+        # 送信用の種別ごとの接続タプル（接続・切断時にだけ作り直す）
+        self._targets: List[tuple] = [(), ()]
+        # 前回の要約ログ以降の接続・切断数
+        self.connected_count = 0
+        self.disconnected_count = 0
+    
+    def count(self, kind: int) -> int:
+        return len(self._targets[kind])
+    
+    def _rebuild_targets(self):
+        clients = self.clients.items()
+        self._targets = [
+            tuple(ws for ws, k in clients if k == AITUBER),
+            tuple(ws for ws, k in clients if k == DASHBOARD),
+        ]
     
     def add_client(self, ws: websockets.WebSocketServerProtocol, is_dashboard=False):
-        if is_dashboard:
-            self.dashboard_clients.add(ws)
-            logger.info(f"✓ ダッシュボード接続 (合計: {len(self.dashboard_clients)})")
-        else:
-            self.clients.add(ws)
-            logger.info(f"✓ クライアント接続 (合計: {len(self.clients)})")
+        self.clients[ws] = DASHBOARD if is_dashboard else AITUBER
+        self.connected_count += 1
+        self._rebuild_targets()
+        logger.debug("✓ %s接続", "ダッシュボード" if is_dashboard else "クライアント")
     
     def remove_client(self, ws: websockets.WebSocketServerProtocol, is_dashboard=False):
-        if is_dashboard:
-            self.dashboard_clients.discard(ws)
-            logger.info(f"✗ ダッシュボード切断 (残り: {len(self.dashboard_clients)})")
-        else:
-            self.clients.discard(ws)
-            logger.info(f"✗ クライアント切断 (残り: {len(self.clients)})")
+        if self.clients.pop(ws, None) is not None:
+            self.disconnected_count += 1
+            self._rebuild_targets()
+        logger.debug("✗ %s切断", "ダッシュボード" if is_dashboard else "クライアント")
     
-    async def broadcast(self, message_data: Dict):
-        if not self.clients:
+    async def log_connection_stats(self, interval: float = 10.0):
+        """接続数の要約を定期的にログ出力（接続・切断のたびには出さない）"""
+        while True:
+            await asyncio.sleep(interval)
+            if not (self.connected_count or self.disconnected_count):
+                continue
+            logger.info(
+                "接続状況: クライアント=%d ダッシュボード=%d (接続 +%d / 切断 -%d)",
+                self.count(AITUBER), self.count(DASHBOARD),
+                self.connected_count, self.disconnected_count
+            )
+            self.connected_count = 0
+            self.disconnected_count = 0
+    
+    def send_all(self, kind: int, payload: str):
+        """エンコード済みのpayloadを指定種別の全クライアントへ送信"""
+        targets = self._targets[kind]
+        if not targets:
             return
         
-        message_json = json.dumps(message_data, ensure_ascii=False)
-        dead = set()
+        # websockets.broadcastはクライアントごとにawaitせず各接続の送信バッファへ書き込む。
+        # 閉じた接続は送信対象から外されるので、登録解除は各ハンドラーのfinallyに任せる
+        websockets.broadcast(targets, payload)
+    
+    async def broadcast(self, message_data: Dict):
+        if not self._targets[AITUBER]:
+            return
         
-        for client in self.clients:
-            try:
-                await client.send(message_json)
-                logger.info(f"✓ 送信: {message_data.get('text', '')[:50]}")
-            except websockets.exceptions.ConnectionClosed:
-                dead.add(client)
+        self.send_all(AITUBER, dumps_json(message_data))
         
-        for client in dead:
-            self.remove_client(client)
+        logger.debug("✓ 送信: %.50s", message_data["text"])
     
     async def broadcast_dashboard(self, data: Dict):
         """ダッシュボード用の状態更新送信"""
-        if not self.dashboard_clients:
+        if not self._targets[DASHBOARD]:
             return
         
-        message_json = json.dumps(data, ensure_ascii=False)
-        dead = set()
-        
-        for client in self.dashboard_clients:
-            try:
-                await client.send(message_json)
-            except websockets.exceptions.ConnectionClosed:
-                dead.add(client)
+        self.send_all(DASHBOARD, dumps_json(data))
+    
+    async def broadcast_dashboard_batch(self, updates: List[Dict]):
+        """1回の取得分の価格更新を1フレームにまとめてダッシュボードへ送信"""
+        if not updates:
+            return
         
-        for client in dead:
-            self.remove_client(client, is_dashboard=True)
+        await self.broadcast_dashboard({
+            "type": "price_batch",
+            "updates": updates
+        })
 
 broker = MessageBroker()
 
 # ==================== 価格監視 ====================
+@dataclass(slots=True)
+class SymbolState:
+    """監視シンボルごとの状態"""
+    digits: int
+    scale: int        # 価格 → 整数ポイントの倍率（10 ** digits）
+    pip_points: int   # 1pipあたりのポイント数
+    inv_pip_points: float  # 1 / pip_points（pips換算を除算でなく乗算で行うため）
+    jp_name: str
+    init_log: str     # 初期価格ログの書式（%形式、価格の桁数は埋め込み済み）
+    reset_log: str    # 基準価格リセットログの書式
+    msg_tmpl: Callable[..., str]
+    base_price: Optional[float] = None
+    base_points: Optional[int] = None
+    last_price: Optional[float] = None
+    last_broadcast_points: Optional[int] = None
+    last_broadcast_pips: Optional[float] = None
+    # 通知のまとめ送り用（最後に送った時刻と、保留中の通知）
+    last_notify_time: float = 0.0
+    pending_level: int = 0
+    pending_message: Optional[Dict] = None
+    pending_log: Optional[tuple] = None   # 保留中の通知のログ引数
+    notify_timer: Optional[asyncio.TimerHandle] = None
+
+# 同じシンボルの通知はこの秒数に1件までにまとめる
+NOTIFY_COALESCE_SECONDS = 1.0
+# 通知ログの書式（シンボル, 日本語名, pips, 方向）
+NOTIFY_LOG = "★ 通知: %s(%s) %.1f pips %s"
+
+# 変動レベル（0: 閾値未満, 1: 小, 2: 中, 3: 大）ごとの（メッセージ設定名, 上昇時の感情, 下降時の感情）
+LEVEL_TABLE = (
+    None,
+    ("msg_small", "happy", "sad"),
+    ("msg_medium", "happy", "sad"),
+    ("msg_large", "surprised", "surprised"),
+)
+
 class PriceMonitor:
     def __init__(self):
-        self.symbol_data = {}
+        self.symbol_data: Dict[str, SymbolState] = {}
         for symbol, info in config.watch_symbols.items():
-            self.symbol_data[symbol] = {
-                "base_price": None,
-                "last_price": None,
-                "digits": info["digits"],
-                "jp_name": info["jp_name"]
-            }
+            # 毎回の書式解析を避けるため、価格ログと通知文の書式はここで組み立てておく
+            escaped_name = info["jp_name"].replace("{", "{{").replace("}", "}}")
+            # 価格は整数ポイントで扱う（3桁/5桁表示の通貨ペアは10ポイント = 1pip）
+            digits = info["digits"]
+            pip_points = 10 if digits in (3, 5) else 1
+            self.symbol_data[symbol] = SymbolState(
+                digits=digits,
+                scale=10 ** digits,
+                pip_points=pip_points,
+                inv_pip_points=1.0 / pip_points,
+                jp_name=info["jp_name"],
+                init_log="✓ %s(%s) 初期価格: %." + str(digits) + "f",
+                reset_log="  → 基準価格リセット: %." + str(digits) + "f",
+                msg_tmpl=(escaped_name + " が {:.1f} pips {} しました\n{}").format
+            )
     
-    def calculate_pips(self, symbol, price_change):
-        digits = self.symbol_data[symbol]["digits"]
+    async def notify(self, state: SymbolState, level: int, message: Dict, log_args: tuple):
+        """変動通知を送信（直前の通知から間もなければ保留し、期間内の最大レベルの1件だけ送る）"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        wait = state.last_notify_time + NOTIFY_COALESCE_SECONDS - now
+        if wait <= 0 and state.notify_timer is None:
+            state.last_notify_time = now
+            logger.info(NOTIFY_LOG, *log_args)
+            await broker.broadcast(message)
+            return
         
-        if digits == 3 or digits == 5:
-            pip_value = 0.1 ** (digits - 1)
+        # 保留中と同じかそれより大きいレベルなら、新しい内容に差し替える
+        if level >= state.pending_level:
+            if state.pending_log is not None:
+                logger.debug("  保留中の通知を差し替え: %s(%s) %.1f pips %s", *state.pending_log)
+            state.pending_level = level
+            state.pending_message = message
+            state.pending_log = log_args
         else:
-            pip_value = 0.1 ** (digits - 2)
-        
-        return abs(price_change) / pip_value
+            logger.debug("  通知を破棄（保留中の通知の方が大きい）: %s(%s) %.1f pips %s", *log_args)
+        if state.notify_timer is None:
+            state.notify_timer = loop.call_later(max(wait, 0.0), self._flush_notify, state)
+    
+    def _flush_notify(self, state: SymbolState):
+        message = state.pending_message
+        logger.info(NOTIFY_LOG, *state.pending_log)
+        state.notify_timer = None
+        state.pending_level = 0
+        state.pending_message = None
+        state.pending_log = None
+        state.last_notify_time = asyncio.get_running_loop().time()
+        # call_laterのコールバックなので、タスクを作らずその場で送信する
+        broker.send_all(AITUBER, dumps_json(message))
+    
+    def thresholds(self):
+        """変動レベル判定用の閾値（小・中・大と、そのうち最小の値）。取得1回ごとに作り直す"""
+        small, medium, large = config.small_threshold, config.medium_threshold, config.large_threshold
+        return (small, medium, large, min(small, medium, large))
     
-    async def update_price(self, symbol, price):
-        if symbol not in config.watch_symbols:
+    async def update_price(self, symbol, price, thresholds=None):
+        state = self.symbol_data.get(symbol)
+        if state is None:
             return
         
-        digits = self.symbol_data[symbol]["digits"]
-        jp_name = self.symbol_data[symbol]["jp_name"]
+        jp_name = state.jp_name
         
-        if self.symbol_data[symbol]["base_price"] is None:
-            self.symbol_data[symbol]["base_price"] = price
-            self.symbol_data[symbol]["last_price"] = price
-            logger.info(f"✓ {symbol}({jp_name}) 初期価格: {price:.{digits}f}")
+        points = round(price * state.scale)
+        
+        if state.base_points is None:
+            state.base_price = price
+            state.base_points = points
+            state.last_price = price
+            logger.info(state.init_log, symbol, jp_name, price)
             return
         
-        base_price = self.symbol_data[symbol]["base_price"]
-        price_change = price - base_price
-        pips_change = self.calculate_pips(symbol, price_change)
+        base_price = state.base_price
+        # 整数演算なので閾値ちょうどの変動で丸め誤差が出ない
+        price_change = points - state.base_points
+        pips_change = abs(price_change) * state.inv_pip_points
+        
+        if thresholds is None:
+            thresholds = self.thresholds()
+        # 0: 閾値未満, 1: 小, 2: 中, 3: 大
+        # ダッシュボードや設定ファイルの閾値は大小順とは限らないので、大きいレベルから順に判定する
+        small, medium, large, floor = thresholds
+        # ほとんどのティックはどの閾値にも届かないので、最小値との比較1回で済ませる
+        if pips_change < floor:
+            level = 0
+        elif pips_change >= large:
+            level = 3
+        elif pips_change >= medium:
+            level = 2
+        elif pips_change >= small:
+            level = 1
+        else:
+            level = 0
         
         level_msg = None
-        emotion = "neutral"
-        
-        if pips_change >= config.large_threshold:
-            level_msg = config.msg_large
-            emotion = "surprised"
-        elif pips_change >= config.medium_threshold:
-            level_msg = config.msg_medium
-            emotion = "happy" if price_change > 0 else "sad"
-        elif pips_change >= config.small_threshold:
-            level_msg = config.msg_small
-            emotion = "happy" if price_change > 0 else "sad"
+        if level:
+            msg_attr, up_emotion, down_emotion = LEVEL_TABLE[level]
+            level_msg = getattr(config, msg_attr)
         
         if level_msg:
-            direction = "上昇" if price_change > 0 else "下降"
+            rising = price_change > 0
+            direction = "上昇" if rising else "下降"
+            emotion = up_emotion if rising else down_emotion
             
             message = {
-                "text": f"{jp_name} が {pips_change:.1f} pips {direction} しました\n{level_msg}",
+                "text": state.msg_tmpl(pips_change, direction, level_msg),
                 "role": "assistant",
                 "emotion": emotion,
                 "type": "message"
             }
             
-            logger.info(f"★ 通知: {symbol}({jp_name}) {pips_change:.1f} pips {direction}")
-            await broker.broadcast(message)
+            await self.notify(state, level, message, (symbol, jp_name, pips_change, direction))
             
-            self.symbol_data[symbol]["base_price"] = price
-            logger.info(f"  → 基準価格リセット: {price:.{digits}f}")
+            state.base_price = price
+            state.base_points = points
+            logger.info(state.reset_log, price)
         
-        self.symbol_data[symbol]["last_price"] = price
+        state.last_price = price
         
-        # ダッシュボードに価格更新を送信
-        await broker.broadcast_dashboard({
-            "type": "price_update",
+        # 前回送信から価格が動いておらず表示上のpipsも同じなら、ダッシュボード送信を省く
+        shown_pips = round(pips_change, 1)
+        if points == state.last_broadcast_points and shown_pips == state.last_broadcast_pips:
+            return None
+        state.last_broadcast_points = points
+        state.last_broadcast_pips = shown_pips
+        
+        # ダッシュボード用の価格更新（送信はupdate_prices_batchでまとめて行う）
+        return {
             "symbol": symbol,
             "jp_name": jp_name,
             "price": price,
             "base_price": base_price,
             "pips_change": pips_change
-        })
+        }
+    
+    async def update_prices_batch(self, ticks):
+        """1回の取得分をまとめて処理し、ダッシュボードへは1フレームで送信"""
+        thresholds = self.thresholds()
+        update_price = self.update_price
+        updates = []
+        for symbol, price in ticks:
+            update = await update_price(symbol, price, thresholds)
+            if update is not None:
+                updates.append(update)
+        
+        await broker.broadcast_dashboard_batch(updates)
     
     def get_status(self):
         """現在の監視状態を取得"""
         status = []
-        for symbol, data in self.symbol_data.items():
+        for symbol, state in self.symbol_data.items():
             status.append({
                 "symbol": symbol,
-                "jp_name": data["jp_name"],
-                "price": data["last_price"],
-                "base_price": data["base_price"]
+                "jp_name": state.jp_name,
+                "price": state.last_price,
+                "base_price": state.base_price
             })
         return status
 
 monitor = PriceMonitor()
 
 # ==================== MT5クライアント ====================
+# 1回のcopy_ticks_fromで取得するティック数の上限
+TICK_FETCH_LIMIT = 4096
+# 更新間隔がダッシュボードから変更されたとき、待機中の監視ループを起こす
+interval_changed = asyncio.Event()
+
 class MT5Client:
     def __init__(self):
         self.running = False
         self.connected = False
+        # MT5 APIはスレッドセーフではないため、呼び出しは専用の1スレッドに直列化する
+        self._mt5_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mt5")
+        # シンボルごとの取得済み最終ティック時刻（ミリ秒）
+        self._last_tick_msc: Dict[str, int] = {}
+    
+    async def _wait_next_tick(self, delay: float) -> bool:
+        """次の取得時刻まで待つ（更新間隔が変更されたら途中で起きてTrueを返す）"""
+        if delay <= 0:
+            return False
+        try:
+            await asyncio.wait_for(interval_changed.wait(), delay)
+        except asyncio.TimeoutError:
+            return False
+        interval_changed.clear()
+        return True
+    
+    async def _call_mt5(self, func, *args):
+        """ブロッキングなMT5呼び出しを専用スレッドで実行"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._mt5_executor, func, *args)
     
-    def connect(self):
+    async def connect(self):
         """MT5に接続"""
         logger.info("=" * 60)
         logger.info("MetaTrader 5 接続開始")
         logger.info("=" * 60)
         
-        if not mt5.initialize():
+        if not await self._call_mt5(mt5.initialize):
+            error = await self._call_mt5(mt5.last_error)
             logger.error("✗ MT5初期化失敗")
-            logger.error(f"  エラー: {mt5.last_error()}")
+            logger.error(f"  エラー: {error}")
             return False
         
-        account_info = mt5.account_info()
+        account_info = await self._call_mt5(mt5.account_info)
         if account_info is None:
             logger.error("✗ 口座情報取得失敗")
             return False
@@ -234,7 +422,7 @@ class MT5Client:
         logger.info("\n監視シンボルの確認:")
         self.available_symbols = []
         for symbol in config.watch_symbols.keys():
-            symbol_info = mt5.symbol_info(symbol)
+            symbol_info = await self._call_mt5(mt5.symbol_info, symbol)
             if symbol_info is None:
                 logger.warning(f"  ⚠ {symbol}: 利用不可（スキップ）")
             else:
@@ -243,11 +431,11 @@ class MT5Client:
                 self.available_symbols.append(symbol)
                 
                 if not symbol_info.visible:
-                    mt5.symbol_select(symbol, True)
+                    await self._call_mt5(mt5.symbol_select, symbol, True)
         
         if not self.available_symbols:
             logger.error("✗ 利用可能なシンボルがありません")
-            mt5.shutdown()
+            await self._call_mt5(mt5.shutdown)
             return False
         
         self.connected = True
@@ -272,45 +460,174 @@ class MT5Client:
         })
         
         self.running = True
+        loop = asyncio.get_running_loop()
+        # 処理時間の分だけ周期が延びないよう、「前回の予定時刻 + 更新間隔」まで待つ
+        next_tick = loop.time()
         
         while self.running:
             try:
-                for symbol in self.available_symbols:
-                    tick = mt5.symbol_info_tick(symbol)
-                    
-                    if tick is None:
-                        continue
-                    
-                    price = tick.bid
-                    await monitor.update_price(symbol, price)
+                # MT5呼び出しはブロッキングなので、全シンボル分をまとめてスレッドで取得
+                ticks = await self._call_mt5(self.fetch_ticks)
+                await monitor.update_prices_batch(ticks)
                 
-                await asyncio.sleep(config.update_interval)
+                # 更新間隔はダッシュボードから変更されるので毎回読み直す
+                interval = config.update_interval
+                next_tick += interval
+                now = loop.time()
+                if next_tick < now - interval:
+                    # 1周期以上遅れたら取り戻そうとせず、ここから数え直す
+                    next_tick = now + interval
+                if await self._wait_next_tick(next_tick - now):
+                    # 新しい更新間隔でここから数え直す
+                    next_tick = loop.time()
                 
             except Exception as e:
-                logger.error(f"✗ 価格取得エラー: {e}")
+                logger.error("✗ 価格取得エラー: %s", e)
                 await asyncio.sleep(5.0)
+                next_tick = loop.time()
+    
+    def _current_tick(self, symbol):
+        """symbol_info_tickで現在のティックを (time_msc, bid) で返す（無効なら None）"""
+        tick = mt5.symbol_info_tick(symbol)
+        # symbol_select直後などは時刻・価格が0のティックが返るので、起点にしない
+        if tick is None or not tick.time_msc or not tick.bid:
+            return None
+        return tick.time_msc, tick.bid
+    
+    def fetch_ticks(self):
+        """前回取得以降に新しいティックが届いたシンボルだけ、最新Bidを (symbol, price) のリストで返す"""
+        # ループ内で毎回引くモジュール属性はローカル変数に束縛しておく
+        copy_ticks_from = mt5.copy_ticks_from
+        current_tick = self._current_tick
+        flags = mt5.COPY_TICKS_INFO
+        last_tick_msc = self._last_tick_msc
+        ticks = []
+        for symbol in self.available_symbols:
+            last_msc = last_tick_msc.get(symbol)
+            if last_msc is None:
+                # 初回は現在のティックを起点にする
+                current = current_tick(symbol)
+                if current is None:
+                    continue
+                last_tick_msc[symbol], price = current
+                ticks.append((symbol, price))
+                continue
+            
+            # copy_ticks_fromは秒単位の起点以降（同じ秒を含む）を返すので、既読分はtime_mscで除く
+            new_ticks = copy_ticks_from(symbol, last_msc // 1000, TICK_FETCH_LIMIT, flags)
+            if new_ticks is None or len(new_ticks) == 0:
+                continue
+            
+            if len(new_ticks) >= TICK_FETCH_LIMIT:
+                # 上限で打ち切られた結果は古い側のティックなので、現在値は取り直して起点も進める
+                current = current_tick(symbol)
+                if current is None or current[0] <= last_msc:
+                    continue
+                last_tick_msc[symbol], price = current
+                ticks.append((symbol, price))
+                continue
+            
+            latest = new_ticks[-1]
+            if latest["time_msc"] <= last_msc:
+                continue
+            
+            last_tick_msc[symbol] = int(latest["time_msc"])
+            ticks.append((symbol, float(latest["bid"])))
+        return ticks
     
     def disconnect(self):
         """MT5切断"""
         if self.connected:
-            mt5.shutdown()
+            self._mt5_executor.submit(mt5.shutdown).result()
             logger.info("✓ MT5切断")
+        self._mt5_executor.shutdown(wait=False)
 
 # ==================== WebSocketサーバー ====================
+# 接続のたびに同じ内容を送るので、エンコード済みの文字列を使い回す
+WELCOME_JSON = dumps_json({
+    "text": "MT5 FX価格監視システムに接続しました",
+    "role": "system",
+    "emotion": "happy",
+    "type": "message"
+})
+CONFIG_UPDATED_JSON = dumps_json({"type": "config_updated", "success": True})
+
+def config_snapshot() -> Dict:
+    """保存・ダッシュボード送信用の設定辞書"""
+    return {
+        "update_interval": config.update_interval,
+        "small_threshold": config.small_threshold,
+        "medium_threshold": config.medium_threshold,
+        "large_threshold": config.large_threshold,
+        "msg_small": config.msg_small,
+        "msg_medium": config.msg_medium,
+        "msg_large": config.msg_large,
+        "watch_symbols": config.watch_symbols
+    }
+
+# ダッシュボード初期化用の設定JSON（設定が変わるまで再利用）
+_config_json_cache: Optional[str] = None
+
+def get_config_json() -> str:
+    global _config_json_cache
+    if _config_json_cache is None:
+        _config_json_cache = dumps_json(config_snapshot())
+    return _config_json_cache
+
+def invalidate_config_json():
+    global _config_json_cache
+    _config_json_cache = None
+
+def get_request_path(websocket) -> str:
+    """接続要求のパスを取得（websocketsのバージョン差を吸収）"""
+    if hasattr(websocket, 'request'):
+        return websocket.request.path
+    if hasattr(websocket, 'path'):
+        return websocket.path
+    return "/"
+
+def is_dashboard_authorized(websocket) -> bool:
+    """ダッシュボード接続のトークン（?token=...）を検証"""
+    if not config.dashboard_token:
+        return True
+    query = parse_qs(urlsplit(get_request_path(websocket)).query)
+    token = query.get("token", [""])[0]
+    return hmac.compare_digest(token.encode("utf-8"), config.dashboard_token.encode("utf-8"))
+
+class TokenBucket:
+    """接続ごとの受信メッセージ数を制限するトークンバケット"""
+    def __init__(self, capacity: int, per_seconds: float):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+    
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+# ダッシュボードから受け付けるメッセージ数の上限（5秒あたり10件）
+DASHBOARD_RATE_LIMIT = (10, 5.0)
+# ダッシュボードから受け付ける1フレームの最大サイズ（バイト）と、未処理フレームの最大数
+DASHBOARD_MAX_SIZE = 16 * 1024
+DASHBOARD_MAX_QUEUE = 16
+# AItuber側は受信内容を使わないので、小さなフレームしか受け付けない
+AITUBER_MAX_SIZE = 4 * 1024
+
 async def websocket_handler(websocket: websockets.WebSocketServerProtocol):
     """AItuber Kit用WebSocketクライアント接続処理"""
     broker.add_client(websocket)
     
     try:
-        welcome = {
-            "text": "MT5 FX価格監視システムに接続しました",
-            "role": "system",
-            "emotion": "happy",
-            "type": "message"
-        }
-        await websocket.send(json.dumps(welcome, ensure_ascii=False))
+        await websocket.send(WELCOME_JSON)
         
-        async for message in websocket:
+        # 受信内容は使わないが、読み続けないと受信キューが詰まり、pongや切断を処理できなくなる
+        async for _ in websocket:
             pass
             
     except (websockets.exceptions.ConnectionClosed, websockets.exceptions.ConnectionClosedError):
@@ -320,34 +637,35 @@ async def websocket_handler(websocket: websockets.WebSocketServerProtocol):
 
 async def dashboard_websocket_handler(websocket: websockets.WebSocketServerProtocol):
     """ダッシュボード用WebSocket接続処理"""
+    if not is_dashboard_authorized(websocket):
+        logger.warning("⚠️ ダッシュボード認証失敗")
+        await websocket.close(code=1008, reason="unauthorized")
+        return
+    
+    rate_limiter = TokenBucket(*DASHBOARD_RATE_LIMIT)
     broker.add_client(websocket, is_dashboard=True)
     
     try:
         # 初期状態を送信
-        initial_state = {
-            "type": "init",
-            "config": {
-                "update_interval": config.update_interval,
-                "small_threshold": config.small_threshold,
-                "medium_threshold": config.medium_threshold,
-                "large_threshold": config.large_threshold,
-                "msg_small": config.msg_small,
-                "msg_medium": config.msg_medium,
-                "msg_large": config.msg_large,
-                "watch_symbols": config.watch_symbols
-            },
-            "status": monitor.get_status()
-        }
-        await websocket.send(json.dumps(initial_state, ensure_ascii=False))
+        # 設定部分はキャッシュ済みJSONを埋め込み、刻々と変わる価格状態だけをエンコード
+        initial_state = (
+            '{"type":"init","config":' + get_config_json()
+            + ',"status":' + dumps_json(monitor.get_status()) + '}'
+        )
+        await websocket.send(initial_state)
         
         async for message in websocket:
+            # 上限を超えたメッセージはJSONを解析せずに捨てる
+            if not rate_limiter.allow():
+                continue
+            
             # 設定変更メッセージを受信
             try:
                 data = json.loads(message)
                 if data.get("type") == "update_config":
                     await handle_config_update(data.get("config", {}))
                     # 更新完了を通知
-                    await websocket.send(json.dumps({"type": "config_updated", "success": True}, ensure_ascii=False))
+                    await websocket.send(CONFIG_UPDATED_JSON)
             except json.JSONDecodeError:
                 logger.error("✗ 不正なJSON受信")
             
@@ -359,7 +677,11 @@ async def dashboard_websocket_handler(websocket: websockets.WebSocketServerProto
 async def handle_config_update(new_config: Dict):
     """設定を更新"""
     if "update_interval" in new_config:
-        config.update_interval = float(new_config["update_interval"])
+        update_interval = float(new_config["update_interval"])
+        # フォームは毎回update_intervalも送ってくるので、値が変わったときだけ監視ループを起こす
+        if update_interval != config.update_interval:
+            interval_changed.set()
+        config.update_interval = update_interval
         logger.info(f"✓ 更新間隔変更: {config.update_interval}秒")
     
     if "small_threshold" in new_config:
@@ -386,32 +708,61 @@ async def handle_config_update(new_config: Dict):
         config.msg_large = new_config["msg_large"]
         logger.info(f"✓ 大変動メッセージ変更")
     
+    invalidate_config_json()
+    
     # 設定をファイルに保存
-    save_config_to_file()
+    schedule_config_save()
 
-def save_config_to_file():
-    """設定をJSONファイルに保存"""
-    config_data = {
-        "update_interval": config.update_interval,
-        "small_threshold": config.small_threshold,
-        "medium_threshold": config.medium_threshold,
-        "large_threshold": config.large_threshold,
-        "msg_small": config.msg_small,
-        "msg_medium": config.msg_medium,
-        "msg_large": config.msg_large,
-        "watch_symbols": config.watch_symbols
-    }
+def encode_config() -> bytes:
+    """現在の設定を保存用JSONにエンコード"""
+    if orjson is not None:
+        return orjson.dumps(config_snapshot(), option=orjson.OPT_INDENT_2)
+    return json.dumps(config_snapshot(), ensure_ascii=False, indent=2).encode("utf-8")
+
+def write_config_file(data: bytes):
+    """設定ファイルを書き込み（一時ファイルに書いてから置き換え、途中で落ちても壊れない）"""
+    tmp_path = CONFIG_FILE + ".tmp"
     try:
-        with open("mt5_config.json", "w", encoding="utf-8") as f:
-            json.dump(config_data, f, ensure_ascii=False, indent=2)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, CONFIG_FILE)
         logger.info("✓ 設定をファイルに保存しました")
     except Exception as e:
         logger.error(f"✗ 設定保存エラー: {e}")
 
+# 連続した設定変更を1回の保存にまとめるための待ち時間（秒）
+CONFIG_SAVE_DELAY = 0.25
+_save_timer: Optional[asyncio.TimerHandle] = None
+# 書き込みが重なると一時ファイルを互いに上書きしてしまうので、保存は専用の1スレッドで順番に行う
+_config_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="config")
+
+def schedule_config_save():
+    """設定保存を予約（書き込みはイベントループ外のスレッドで実行）"""
+    global _save_timer
+    if _save_timer is not None:
+        _save_timer.cancel()
+    loop = asyncio.get_running_loop()
+    _save_timer = loop.call_later(CONFIG_SAVE_DELAY, _flush_config_save, loop)
+
+def _flush_config_save(loop: asyncio.AbstractEventLoop):
+    global _save_timer
+    _save_timer = None
+    # 設定の読み出しはループ上で行い、ディスク書き込みだけをスレッドに渡す
+    loop.run_in_executor(_config_executor, write_config_file, encode_config())
+
+def flush_config_save():
+    """予約中の保存をすぐに書き込み、実行中の書き込みも含めて完了を待つ（終了時用）"""
+    global _save_timer
+    if _save_timer is not None:
+        _save_timer.cancel()
+        _save_timer = None
+        _config_executor.submit(write_config_file, encode_config())
+    _config_executor.shutdown(wait=True)
+
 def load_config_from_file():
     """設定をJSONファイルから読み込み"""
     try:
-        with open("mt5_config.json", "r", encoding="utf-8") as f:
+        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
             config_data = json.load(f)
         
         config.update_interval = config_data.get("update_interval", config.update_interval)
@@ -427,6 +778,7 @@ def load_config_from_file():
             for symbol, data in config_data["watch_symbols"].items():
                 if symbol in config.watch_symbols:
                     config.watch_symbols[symbol].update(data)
+        invalidate_config_json()
         
         logger.info("✓ 保存された設定を読み込みました")
         return True
@@ -437,33 +789,63 @@ def load_config_from_file():
         logger.error(f"✗ 設定読み込みエラー: {e}")
         return False
 
-async def start_websocket_server():
-    """WebSocketサーバー起動"""
+_external_ip: Optional[str] = None
+
+def discover_external_ip() -> str:
+    """LAN側のIPアドレスを調べる（UDPのconnectなので実際には送信しない）"""
     import socket
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
             s.connect(("8.8.8.8", 80))
-            external_ip = s.getsockname()[0]
+            return s.getsockname()[0]
     except Exception:
-        external_ip = "N/A"
+        return "N/A"
+
+async def get_external_ip() -> str:
+    """表示用IPアドレス（設定があればそれを使い、なければ検出結果をキャッシュ）"""
+    global _external_ip
+    if config.external_ip:
+        return config.external_ip
+    if _external_ip is None:
+        _external_ip = await asyncio.to_thread(discover_external_ip)
+    return _external_ip
 
+async def start_websocket_server():
+    """WebSocketサーバー起動"""
     logger.info("=" * 60)
     logger.info("WebSocketサーバー起動")
     logger.info(f"  - AItuber Kit用: ws://localhost:{config.ws_port}")
     logger.info(f"  - ダッシュボード用: ws://localhost:{config.ws_port + 1}")
     if config.ws_host == "0.0.0.0":
+        external_ip = await get_external_ip()
         logger.info(f"  - ネットワーク: ws://{external_ip}:{config.ws_port}")
     logger.info("=" * 60)
     
     # 2つのWebSocketサーバーを起動
-    async with websockets.serve(websocket_handler, config.ws_host, config.ws_port), \
-               websockets.serve(dashboard_websocket_handler, config.ws_host, config.ws_port + 1):
+    # 送信するのは数百バイト程度の小さなJSONだけなので、permessage-deflateは無効化
+    async with websockets.serve(websocket_handler, config.ws_host, config.ws_port,
+                                compression=None, max_size=AITUBER_MAX_SIZE), \
+               websockets.serve(dashboard_websocket_handler, config.ws_host, config.ws_port + 1,
+                                compression=None, max_size=DASHBOARD_MAX_SIZE,
+                                max_queue=DASHBOARD_MAX_QUEUE):
         await asyncio.Future()
 
 # ==================== HTTPサーバー（ダッシュボード） ====================
 async def http_handler(request):
-    """ダッシュボードHTMLを返す"""
-    return web.Response(text=DASHBOARD_HTML, content_type='text/html', charset='utf-8')
+    """ダッシュボードHTMLを返す（gzip対応クライアントには圧縮済みのもの、ETag一致なら304）"""
+    headers = {
+        "Cache-Control": "public, max-age=3600",
+        "Vary": "Accept-Encoding",
+        "ETag": DASHBOARD_HTML_ETAG
+    }
+    if DASHBOARD_HTML_ETAG in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers=headers)
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        body = DASHBOARD_HTML_GZIP
+    else:
+        body = DASHBOARD_HTML_BYTES
+    return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
 
 async def start_http_server():
     """HTTPサーバー起動"""
@@ -627,6 +1009,9 @@ DASHBOARD_HTML = """
             margin-top: 5px;
             font-weight: bold;
         }
+        .price-item.pulse-play {
+            animation: pulse 0.5s ease;
+        }
         .form-group {
             margin-bottom: 20px;
             position: relative;
@@ -802,7 +1187,9 @@ DASHBOARD_HTML = """
     </div>
     
     <script>
-        const ws = new WebSocket('ws://localhost:8001');
+        // ページURLの ?token=... をダッシュボード用WebSocketにそのまま渡す
+        const token = new URLSearchParams(location.search).get('token');
+        const ws = new WebSocket('ws://localhost:8001' + (token ? '?token=' + encodeURIComponent(token) : ''));
         const statusEl = document.getElementById('status');
         const priceGrid = document.getElementById('priceGrid');
         const form = document.getElementById('configForm');
@@ -826,8 +1213,10 @@ DASHBOARD_HTML = """
                 currentConfig = data.config;
                 updateForm(data.config);
                 updatePriceGrid(data.status);
-            } else if (data.type === 'price_update') {
-                updatePrice(data);
+            } else if (data.type === 'price_batch') {
+                for (const update of data.updates) {
+                    updatePrice(update);
+                }
             } else if (data.type === 'config_updated') {
                 // 可愛いアラート
                 const alertDiv = document.createElement('div');
@@ -867,27 +1256,73 @@ DASHBOARD_HTML = """
             document.getElementById('msgLarge').value = config.msg_large;
         }
         
+        // シンボルごとのDOMノードは初回だけ生成し、以降は値の差し替えで再利用する
+        const priceNodes = new Map();
+        
+        function createPriceNode(item) {
+            const el = document.createElement('div');
+            el.className = 'price-item positive';
+            el.id = `price-${item.symbol}`;
+            el.innerHTML = `
+                <h3>${item.symbol}</h3>
+                <div class="jp-name">${item.jp_name}</div>
+                <div class="price">---</div>
+                <div class="pips">📈 0.0 pips</div>
+            `;
+            return el;
+        }
+        
         function updatePriceGrid(status) {
-            priceGrid.innerHTML = status.map(item => {
-                const pips = item.price && item.base_price 
-                    ? ((item.price - item.base_price) / 0.01).toFixed(1)
-                    : '0.0';
-                const direction = parseFloat(pips) >= 0 ? 'positive' : 'negative';
-                const arrow = parseFloat(pips) >= 0 ? '📈' : '📉';
-                
-                return `
-                    <div class="price-item ${direction}" id="price-${item.symbol}">
-                        <h3>${item.symbol}</h3>
-                        <div class="jp-name">${item.jp_name}</div>
-                        <div class="price">${item.price ? item.price.toFixed(3) : '---'}</div>
-                        <div class="pips">${arrow} ${pips} pips</div>
-                    </div>
-                `;
-            }).join('');
+            if (priceNodes.size === 0) priceGrid.textContent = '';
+        
+            for (const item of status) {
+                if (!priceNodes.has(item.symbol)) {
+                    const el = createPriceNode(item);
+                    priceNodes.set(item.symbol, el);
+                    priceGrid.appendChild(el);
+                }
+                if (item.price) {
+                    updatePrice({
+                        symbol: item.symbol,
+                        price: item.price,
+                        pips_change: item.base_price ? (item.price - item.base_price) / 0.01 : 0
+                    });
+                }
+            }
+        }
+        
+        // 受信した価格更新はシンボルごとに最新の1件だけ保持し、描画は1フレームに1回まとめて行う
+        const pendingPrices = new Map();
+        let rafId = 0;
+        
+        function scheduleRender() {
+            if (rafId) return;
+            rafId = requestAnimationFrame(flushPrices);
+        }
+        
+        function flushPrices() {
+            rafId = 0;
+            const rendered = [];
+            for (const data of pendingPrices.values()) {
+                const el = renderPrice(data);
+                if (el) rendered.push(el);
+            }
+            pendingPrices.clear();
+        
+            // className の再設定で pulse-play が外れるので、リフローを1回だけ挟んでまとめて付け直す
+            if (rendered.length) {
+                void priceGrid.offsetWidth;
+                for (const el of rendered) el.classList.add('pulse-play');
+            }
         }
         
         function updatePrice(data) {
-            const el = document.getElementById(`price-${data.symbol}`);
+            pendingPrices.set(data.symbol, data);
+            scheduleRender();
+        }
+        
+        function renderPrice(data) {
+            const el = priceNodes.get(data.symbol);
             if (!el) return;
             
             const direction = data.pips_change >= 0 ? 'positive' : 'negative';
@@ -895,12 +1330,7 @@ DASHBOARD_HTML = """
             el.className = `price-item ${direction}`;
             el.querySelector('.price').textContent = data.price.toFixed(3);
             el.querySelector('.pips').textContent = `${arrow} ${data.pips_change.toFixed(1)} pips`;
-            
-            // キラキラエフェクト
-            el.style.animation = 'none';
-            setTimeout(() => {
-                el.style.animation = 'pulse 0.5s ease';
-            }, 10);
+            return el;
         }
         
         form.onsubmit = (e) => {
@@ -940,6 +1370,12 @@ DASHBOARD_HTML = """
 </html>
 """
 
+# リクエストごとのエンコード・圧縮を避けるため、配信用のバイト列を用意しておく
+DASHBOARD_HTML_BYTES = DASHBOARD_HTML.encode("utf-8")
+DASHBOARD_HTML_GZIP = gzip.compress(DASHBOARD_HTML_BYTES, compresslevel=6)
+# 内容が変わらない限り同じ値なので、再読み込み時は304で本文を省略できる
+DASHBOARD_HTML_ETAG = 'W/"' + hashlib.md5(DASHBOARD_HTML_BYTES).hexdigest() + '"'
+
 # ==================== 準備 (Setup) ====================
 def initial_setup():
     """起動前の依存関係チェック"""
@@ -967,6 +1403,17 @@ def initial_setup():
     
     return True
 
+def fast_loop_factory() -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    """uvloop（Windowsではwinloop）がインストールされていれば、asyncio.runに渡すループ生成関数を返す"""
+    try:
+        if sys.platform == "win32":
+            import winloop as fast_loop
+        else:
+            import uvloop as fast_loop
+    except ImportError:
+        return None
+    return fast_loop.new_event_loop
+
 # ==================== メイン ====================
 async def main():
     print("\n" + "=" * 60)
@@ -986,7 +1433,7 @@ async def main():
     
     client = MT5Client()
     
-    if not client.connect():
+    if not await client.connect():
         logger.error("\nMT5接続失敗。プログラムを終了します。")
         return
     
@@ -995,12 +1442,14 @@ async def main():
         await asyncio.gather(
             start_http_server(),
             start_websocket_server(),
-            client.start_monitoring()
+            client.start_monitoring(),
+            broker.log_connection_stats()
         )
     except KeyboardInterrupt:
         logger.info("\n✓ 停止")
     finally:
         client.disconnect()
+        flush_config_save()
 
 if __name__ == '__main__':
     if initial_setup():
@@ -1010,7 +1459,10 @@ if __name__ == '__main__':
         print("  ※ aiohttp未インストールの場合: pip install aiohttp")
         input("\n準備ができたらEnterで起動...")
         print()
+        loop_factory = fast_loop_factory()
+        if loop_factory is not None:
+            print("高速イベントループを使用します")
         try:
-            asyncio.run(main())
+            asyncio.run(main(), loop_factory=loop_factory)
         except KeyboardInterrupt:
             print("\n✓ 停止")
\ No newline at end of file